@@ -17,10 +17,17 @@ def run():
     commands = argument_parser.add_subparsers(dest="command")
 
     populate_parser = commands.add_parser("populate")
+    populate_parser.add_argument(
+        "--full-rescan",
+        action="store_true",
+        default=False,
+        help="list all files instead of continuing from the saved cursor",
+    )
     populate_parser.set_defaults(action=populate)
 
-    arguments = argument_parser.parse_args()
-    action = arguments.action
+    arguments = vars(argument_parser.parse_args())
+    arguments.pop("command")
+    action = arguments.pop("action", None)
 
     import pdb
 
@@ -28,4 +35,4 @@ def run():
 
     if not isinstance(action, Callable):
         raise ValueError(f"Unknown action {action}")
-    action()
+    action(**arguments)
@@ -2,35 +2,161 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
+import mmap
 import os
 import subprocess
-from concurrent.futures import ThreadPoolExecutor, wait
-from datetime import datetime
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from functools import partial
 from hashlib import sha256
-from itertools import groupby
 from pathlib import Path
-from time import sleep
+from random import random
+from stat import S_ISREG
+from threading import Condition, Lock, Semaphore
+from time import monotonic, sleep
+from typing import Any, Callable, Generator, Iterable
 
 import sqlalchemy as sa
 import yaml
-from dropbox import Dropbox
+from dropbox import Dropbox, create_session
+from dropbox.exceptions import RateLimitError
 from requests import ConnectionError, ReadTimeout
+from requests.exceptions import ChunkedEncodingError
+from sqlalchemy.orm import Session
+from tqdm import tqdm
+
+try:
+    from libzfs_core import lzc_snapshot
+    from libzfs_core.exceptions import SnapshotFailure
+except ImportError:  # pyzfs is optional
+    lzc_snapshot = None
 
 from .log import logger
-from .schema import ConnectionManager, DeleteEvent, FileEvent, ModifyEvent, SymlinkEvent
+from .schema import ConnectionManager, FileEvent, VerifiedRevision
 
 chunk_size = 2**8
+max_delay = 6e1
+block_size = 2**22  # dropbox content hash block size
+download_chunk_size = 2**20
+large_file_size = 2**24
+max_workers = 64
 connection_manager = ConnectionManager()
 
+file_events: sa.Table = FileEvent.__table__
+
 with open("config.yml", "r") as file_handle:
     configuration = yaml.load(file_handle, Loader=yaml.Loader)
 
-dbx = Dropbox(configuration["dropbox_token"])
+# the default pool keeps 8 connections, fewer than we have threads. dropbox paces
+# requests per user. rate limit errors are not retried by the sdk, so that they
+# reach robust_call and the limiter can back off
+dbx = Dropbox(
+    configuration["dropbox_token"],
+    max_retries_on_rate_limit=0,
+    session=create_session(max_connections=max_workers),
+)
 
 zfs_data_set = configuration["zfs_data_set"]
 base_path = Path(f"/{zfs_data_set}")
 
 
+class AdaptiveLimiter:
+    """
+    Bounds the number of concurrent downloads. Every `interval` seconds the
+    limit is increased additively if throughput went up, and it is halved
+    whenever dropbox asks us to back off
+
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        minimum: int = 1,
+        maximum: int = max_workers,
+        step: int = 2,
+        interval: float = 5.0,
+    ) -> None:
+        self.limit = limit
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.interval = interval
+
+        self.active = 0
+        self.condition = Condition()
+
+        self.transferred = 0
+        self.throughput = 0.0
+        self.interval_start = monotonic()
+
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify()
+
+    def record(self, size: int) -> None:
+        with self.condition:
+            self.transferred += size
+
+            now = monotonic()
+            elapsed = now - self.interval_start
+            if elapsed < self.interval:
+                return
+
+            throughput = self.transferred / elapsed
+            if throughput > self.throughput:
+                self.limit = min(self.maximum, self.limit + self.step)
+                logger.debug(f"Increase download concurrency to {self.limit}")
+                self.condition.notify_all()
+
+            self.throughput = throughput
+            self.transferred = 0
+            self.interval_start = now
+
+    def decrease(self) -> None:
+        with self.condition:
+            self.limit = max(self.minimum, self.limit // 2)
+            logger.debug(f"Decrease download concurrency to {self.limit}")
+
+
+# shared by all batches so that worker threads are not recreated for every snapshot
+executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+# large files are bound by disk throughput. they get their own workers so that small
+# files are downloaded alongside them
+large_file_executor = ThreadPoolExecutor(
+    max_workers=3, thread_name_prefix="download-large"
+)
+# hashlib releases the gil, so blocks are hashed in parallel with the downloads
+hash_workers = os.cpu_count() or 1
+hash_executor = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="hash")
+# received blocks waiting to be hashed, so that a fast download cannot fill memory
+hash_slots = Semaphore(2 * hash_workers)
+
+small_file_limiter = AdaptiveLimiter(configuration.get("download_concurrency", 8))
+
+# directory -> mtime to set at the end of the current batch
+parent_mtimes: dict[Path, float] = dict()
+parent_mtimes_lock = Lock()
+
+# held while creating files or removing empty directories, so that a directory is
+# not removed while another worker creates a file in it
+directory_lock = Lock()
+
+# (path, revision) -> (size, mtime) of files whose hash was already checked
+verified_revisions: dict[tuple[str, str], tuple[int, int]] = dict()
+pending_verified_revisions: list[dict[str, Any]] = list()  # written once per batch
+verified_revisions_lock = Lock()
+
+
 def dropbox_hash(path: Path):
     """
 
@@ -39,18 +165,75 @@ def dropbox_hash(path: Path):
     """
     block_hashes = b""
     with open(path, "rb") as file_handle:
-        while chunk := file_handle.read(4194304):
-            block_hashes += sha256(chunk).digest()
+        size = os.fstat(file_handle.fileno()).st_size
+        if size > 0:  # cannot map an empty file
+            with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise"):  # larger readahead
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+
+                with memoryview(mm) as view:
+                    offsets = range(0, size, block_size)
+                    # blocks are independent, so they are hashed in parallel
+                    block_hashes = b"".join(
+                        hash_executor.map(partial(hash_mapped_block, view), offsets)
+                    )
+
     return sha256(block_hashes).hexdigest()
 
 
+def hash_mapped_block(view: memoryview, offset: int) -> bytes:
+    # release the slice right away, the map cannot be closed while it exists
+    with view[offset : offset + block_size] as block:
+        return block_digest(block)
+
+
+def block_digest(block: bytes | bytearray | memoryview) -> bytes:
+    return sha256(block).digest()
+
+
+class ContentHasher:
+    """
+    Incremental version of `dropbox_hash` for data that arrives in chunks. Full
+    blocks are hashed on the executor so that the caller can keep receiving, but
+    the caller waits while all `slots` are taken by blocks that were not hashed yet
+
+    """
+
+    def __init__(self, executor: Executor, slots: Semaphore) -> None:
+        self.executor = executor
+        self.slots = slots
+        self.block_hashes: list[Future[bytes]] = list()
+        self.block = bytearray()
+
+    def update(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            size = min(block_size - len(self.block), len(view))
+            self.block.extend(view[:size])
+            view = view[size:]
+
+            if len(self.block) == block_size:
+                self.slots.acquire()
+                future = self.executor.submit(block_digest, self.block)
+                future.add_done_callback(lambda _: self.slots.release())
+                self.block_hashes.append(future)
+                self.block = bytearray()
+
+    def hexdigest(self) -> str:
+        block_hashes = b"".join(future.result() for future in self.block_hashes)
+        if self.block:
+            block_hashes += block_digest(self.block)
+        return sha256(block_hashes).hexdigest()
+
+
 def is_empty(path: Path) -> bool:
     try:
-        for child in path.iterdir():
-            if child.name == ".zfs":  # not a real file
-                continue
-            return False
-    except (FileNotFoundError, StopIteration):
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                if entry.name == ".zfs":  # not a real file
+                    continue
+                return False
+    except (FileNotFoundError, NotADirectoryError):
         pass
 
     return True
@@ -62,169 +245,454 @@ def set_mtime(path: Path, seconds: float, update_parents: bool = False):
         for parent in path.parents:
             if parent == base_path:
                 break
-            os.utime(parent, times=(seconds, seconds))
+            set_parent_mtime(parent, seconds)
+
+
+def set_parent_mtime(path: Path, seconds: float):
+    # deferred until the end of the batch, where the latest event wins
+    with parent_mtimes_lock:
+        parent_mtimes[path] = max(parent_mtimes.get(path, seconds), seconds)
+
+
+def flush_parent_mtimes():
+    with parent_mtimes_lock:
+        items = sorted(
+            parent_mtimes.items(), key=lambda item: len(item[0].parts), reverse=True
+        )
+        parent_mtimes.clear()
+
+    for path, seconds in items:
+        try:
+            os.utime(path, times=(seconds, seconds))
+        except FileNotFoundError:  # removed later in the batch
+            continue
 
 
 def truncate(path: Path):
     path.parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "w"):  # empty file as placeholder
-        pass
+    create_empty(path)
+
+
+def create_empty(path: Path):  # empty file as placeholder
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666))
+
+
+def create_new(path: Path) -> bool:
+    """
+    Creates an empty file and returns whether it did not exist before, which
+    saves a separate stat
+
+    """
+    try:
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+    except FileExistsError:
+        return False
+    return True
+
+
+def load_verified_revisions(session: Session):
+    query = session.query(
+        VerifiedRevision.path,
+        VerifiedRevision.revision,
+        VerifiedRevision.size,
+        VerifiedRevision.mtime,
+    )
+    for path, revision, size, mtime in query:
+        verified_revisions[(path, revision)] = (size, mtime)
+
+
+def is_verified(path: Path, file: sa.Row) -> bool:
+    verified = verified_revisions.get((file.path, file.revision))
+    if verified is None:
+        return False
+
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return False
+
+    return (stat.st_size, stat.st_mtime_ns) == verified
+
+
+def has_content(path: Path, file: sa.Row, seconds: float) -> bool:
+    """
+    Whether the file on disk already has the content of the revision because an
+    earlier run was interrupted before it could record it as verified. That run
+    has set the mtime to the time of the event, so other files are not hashed
+
+    """
+    if not isinstance(file.content_hash, str) or not isinstance(file.size, int):
+        return False
+
+    try:
+        stat = path.lstat()
+    except FileNotFoundError:
+        return False
+
+    if not S_ISREG(stat.st_mode):
+        return False
+    if abs(stat.st_mtime - seconds) > 1e-6:  # not written by an earlier run
+        return False
+    if stat.st_size != file.size:  # only hash when it can match
+        return False
+    return dropbox_hash(path) == file.content_hash
+
+
+def mark_verified(path: Path, file: sa.Row):
+    stat = path.stat()
+    size, mtime = stat.st_size, stat.st_mtime_ns
+    verified_revision = dict(
+        path=file.path,
+        revision=file.revision,
+        content_hash=file.content_hash,
+        size=size,
+        mtime=mtime,
+    )
+
+    with verified_revisions_lock:
+        verified_revisions[(file.path, file.revision)] = (size, mtime)
+        pending_verified_revisions.append(verified_revision)
+
+
+def flush_verified_revisions():
+    with verified_revisions_lock:
+        rows = pending_verified_revisions.copy()
+        pending_verified_revisions.clear()
+
+    if len(rows) == 0:
+        return
+
+    table = VerifiedRevision.__table__
+    insert = sa.insert(table).prefix_with("OR REPLACE", dialect="sqlite")
+    with connection_manager.make_session() as session:
+        session.execute(insert, rows)
+        session.commit()
 
 
 def robust_call(func, *args, **kwargs):
+    delay = 1.0
     while True:
         try:
             return func(*args, **kwargs)
-        except (ReadTimeout, ConnectionError) as e:
+        except (ReadTimeout, ConnectionError, ChunkedEncodingError) as e:
             logger.error("Network error %s", exc_info=e)
-            sleep(1e1)
+            sleep(min(delay, max_delay) + random())  # jitter spreads out threads
+            delay *= 2
+        except RateLimitError as e:
+            logger.warning("Rate limited %s", exc_info=e)
+            small_file_limiter.decrease()
+            sleep((e.backoff or min(delay, max_delay)) + random())
+
+
+def download_to_file(path: Path, file: sa.Row) -> str | None:
+    """
+    Writes the revision to path while it is being received, so that the content
+    hash is calculated without reading the file back from disk
+
+    Returns the content hash if the revision has one to compare against
+
+    """
+    _, response = dbx.files_download(f"rev:{file.revision}")
 
+    hasher: ContentHasher | None = None
+    if isinstance(file.content_hash, str):
+        hasher = ContentHasher(hash_executor, hash_slots)
 
-def download_file(file: FileEvent):
+    with response, open(path, "wb") as file_handle:
+        for chunk in response.iter_content(chunk_size=download_chunk_size):
+            file_handle.write(chunk)
+            small_file_limiter.record(len(chunk))
+            if hasher is not None:
+                hasher.update(chunk)
+
+    if hasher is None:
+        return None
+    return hasher.hexdigest()
+
+
+def event_path(file: sa.Row) -> Path:
     if not isinstance(file.path, str):
         raise ValueError('File object is missing "path" attribute')
-    path = base_path / file.path.lstrip("/")
+    return base_path / file.path.lstrip("/")
+
 
+def event_seconds(file: sa.Row) -> float:
     if not isinstance(file.timestamp, datetime):
         raise ValueError('File object is missing "timestamp" attribute')
-    seconds = file.timestamp.timestamp()
+    return file.timestamp.timestamp()
 
-    if isinstance(file, ModifyEvent):
-        is_new_file = not path.is_file()
 
-        truncate(path)
+def is_large(file: sa.Row) -> bool:
+    if file.type != "modify" or file.is_downloadable is not True:
+        return False
+    return isinstance(file.size, int) and file.size >= large_file_size
+
+
+def download_modify(file: sa.Row):
+    path = event_path(file)
+    seconds = event_seconds(file)
+
+    if is_verified(path, file):
+        logger.debug(f'Skip verified "{path}" at "{file.revision}"')
+        return
 
-        if file.is_downloadable is True:
-            logger.info(f'Download "{path}" at "{file.revision}"')
-            robust_call(
-                dbx.files_download_to_file,
-                path,
-                f"rev:{file.revision}",
-            )
+    if file.is_downloadable is True and has_content(path, file, seconds):
+        logger.debug(f'Skip unchanged "{path}" at "{file.revision}"')
+        set_mtime(path, seconds)
+        mark_verified(path, file)
+        return
 
-            if isinstance(file.content_hash, str):
-                if not dropbox_hash(path) == file.content_hash:
-                    raise ValueError(f'"{path}" hash mismatch')
+    with directory_lock:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        is_new_file = create_new(path)
+    if not is_new_file:  # empty file as placeholder, also if the download fails
+        os.truncate(path, 0)
 
-        set_mtime(path, seconds, update_parents=is_new_file)
+    if file.is_downloadable is True:
+        logger.info(f'Download "{path}" at "{file.revision}"')
+        if is_large(file):  # bounded by large_file_executor
+            content_hash = robust_call(download_to_file, path, file)
+        else:
+            with small_file_limiter.slot():
+                content_hash = robust_call(download_to_file, path, file)
+
+        if content_hash is not None:
+            if not content_hash == file.content_hash:
+                raise ValueError(f'"{path}" hash mismatch')
+
+    set_mtime(path, seconds, update_parents=is_new_file)
+
+    if file.is_downloadable is True and isinstance(file.content_hash, str):
+        mark_verified(path, file)
 
-    elif isinstance(file, SymlinkEvent):
-        is_new_file = not path.is_file()
 
+def download_symlink(file: sa.Row):
+    path = event_path(file)
+
+    if not isinstance(file.target, str):
+        raise ValueError('File object is missing "target" attribute')
+    target = base_path / file.target.lstrip("/")
+
+    with directory_lock:
         truncate(path)
 
         path.unlink()
 
-        if not isinstance(file.target, str):
-            raise ValueError('File object is missing "target" attribute')
-        target = base_path / file.target.lstrip("/")
         path.symlink_to(target)
 
-    elif isinstance(file, DeleteEvent):
-        if path.is_file():
-            logger.debug(f'Delete "{path}"')
-            path.unlink()
-        else:
-            logger.warning(f'Cannot delete non-existent "{path}"')
 
+def download_delete(file: sa.Row):
+    path = event_path(file)
+    seconds = event_seconds(file)
+
+    try:
+        path.unlink()
+        logger.debug(f'Delete "{path}"')
+    except (FileNotFoundError, IsADirectoryError):
+        logger.warning(f'Cannot delete non-existent "{path}"')
+
+    with directory_lock:
         for parent in path.parents:
             if parent == base_path:
                 break
-            if not parent.is_dir():
-                continue
 
-            if is_empty(parent):
+            if is_empty(parent):  # also true if it does not exist
+                try:
+                    parent.rmdir()
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
                 logger.debug(f'Delete empty directory "{parent}"')
-                parent.rmdir()
             else:  # update mtime on delete
-                set_mtime(parent, seconds)
+                set_parent_mtime(parent, seconds)
 
-    else:
+
+# file.type -> handler
+download_handlers: dict[str, Callable[[sa.Row], None]] = dict(
+    modify=download_modify,
+    symlink=download_symlink,
+    delete=download_delete,
+)
+
+
+def download_file(file: sa.Row):
+    handler = download_handlers.get(file.type)
+    if handler is None:
         raise NotImplementedError(f'file.type="{file.type}"')
+    handler(file)
 
 
-def take_snapshot(snap_datetime: datetime):
+def snapshot_name(snap_datetime: datetime) -> str:
     microseconds = snap_datetime.microsecond
     milliseconds = microseconds // 1000
     if not milliseconds < 1000:
         raise ValueError(f"Invalid microseconds {microseconds}")
 
     snap_date_format = "%Y%m%d_%H%M%S"
-    snap_name = f"dbx_{snap_datetime.strftime(snap_date_format)}_{milliseconds:03d}"
+    return f"dbx_{snap_datetime.strftime(snap_date_format)}_{milliseconds:03d}"
+
+
+def list_snapshots() -> set[str]:
+    command = ["zfs", "list", "-H", "-t", "snapshot", "-o", "name", "-d", "1"]
+    output = subprocess.check_output([*command, zfs_data_set], text=True)
+    return {line.partition("@")[2] for line in output.splitlines()}
+
+
+def take_snapshot(snap_datetime: datetime):
+    snap_name = snapshot_name(snap_datetime)
+
+    if lzc_snapshot is not None:  # skip starting the zfs command
+        logger.info(f'Create snapshot "{zfs_data_set}@{snap_name}"')
+        try:
+            lzc_snapshot([f"{zfs_data_set}@{snap_name}".encode()])
+        except SnapshotFailure as e:
+            logger.error("Cannot create snapshot %s", snap_name, exc_info=e)
+        return
 
     command = ["zfs", "snapshot", f"{zfs_data_set}@{snap_name}"]
     logger.info(f'Run "{" ".join(command)}"')
     subprocess.call(command)
 
 
-def download_revisions(file_events: list[FileEvent]):
-    # input is already sorted
-    seen = set()
-    for i, file in enumerate(file_events):
-        if file.path in seen:  # duplicate
-            download_revisions(file_events[:i])  # split
-            download_revisions(file_events[i:])
-            return
-        seen.add(file.path)
+def split_batches(
+    file_events: Iterable[sa.Row],
+) -> Generator[list[sa.Row], None, None]:
+    # input is already sorted, split it into batches where each path occurs once
+    batch: dict[str, sa.Row] = dict()
+    for file in file_events:
+        if file.path in batch:  # duplicate
+            yield list(batch.values())
+            batch = dict()
+        batch[file.path] = file
+
+    if len(batch) > 0:
+        yield list(batch.values())
 
-    # modify files
-    with ThreadPoolExecutor(max_workers=4) as executor:
+
+def download_revisions(file_events: Iterable[sa.Row], snapshots: set[str]):
+    for batch in split_batches(file_events):
+        # completed by a previous run, which was interrupted later in the day
+        snap_datetime = batch[-1].timestamp
+        if snapshot_name(snap_datetime) in snapshots:
+            logger.debug(f"Skip batch with existing snapshot at {snap_datetime}")
+            continue
+
+        # modify files
         futures = list()
-        for file in file_events:
-            futures.append(executor.submit(download_file, file))
+        for file in batch:
+            file_executor = large_file_executor if is_large(file) else executor
+            futures.append(file_executor.submit(download_file, file))
 
         wait(futures)
 
-    take_snapshot(file_events[-1].timestamp)
+        for file, future in zip(batch, futures):
+            exception = future.exception()
+            if exception is not None:
+                logger.error(
+                    f'Cannot process "{file.path}" at "{file.revision}"',
+                    exc_info=exception,
+                )
 
+        flush_parent_mtimes()
+        flush_verified_revisions()  # before the snapshot so that resume sees them
+        take_snapshot(snap_datetime)
 
-def download():
-    # setup
-    session = connection_manager.make_session()
+
+def make_initial_state(session: Session, min_datetime: datetime):
     chunk_size = 1024
 
-    # initial state
     if not is_empty(base_path):
         raise ValueError(f'"{base_path}" is not empty')
-    (min_datetime,) = session.query(sa.func.min(FileEvent.timestamp)).one()
     seconds = min_datetime.timestamp()
 
-    path = FileEvent.path.label("path")
-    type = FileEvent.type.label("type")
-    row_number = (
-        sa.func.row_number()
-        .over(order_by=FileEvent.timestamp.asc(), partition_by=FileEvent.path)
-        .label("row_number")
+    # paths whose first event is a delete
+    first_timestamp = (
+        session.query(
+            FileEvent.path.label("path"),
+            sa.func.min(FileEvent.timestamp).label("timestamp"),
+        )
+        .group_by(FileEvent.path)
+        .subquery()
     )
 
-    subquery = session.query(path, type, row_number).subquery()
-
     query = (
-        session.query(subquery.c.path)
-        .filter(subquery.c.row_number == 1)
-        .filter(subquery.c.type == "delete")
+        session.query(FileEvent.path)
+        .join(
+            first_timestamp,
+            sa.and_(
+                FileEvent.path == first_timestamp.c.path,
+                FileEvent.timestamp == first_timestamp.c.timestamp,
+            ),
+        )
+        .filter(FileEvent.type == "delete")
     )
 
     query = query.yield_per(chunk_size)
 
+    parents: set[Path] = set()
     for (path,) in query:
         path = base_path / path.lstrip("/")
 
-        truncate(path)
-        set_mtime(path, seconds, update_parents=True)
+        if path.parent not in parents:  # create each directory only once
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+            for parent in path.parents:
+                if parent == base_path:
+                    break
+                if parent in parents:  # so are all of its parents
+                    break
+                parents.add(parent)
+
+        create_empty(path)
+        os.utime(path, times=(seconds, seconds))
+
+    for parent in parents:  # after all files were created
+        set_mtime(parent, seconds)
 
     take_snapshot(min_datetime)
 
-    # modifications
-    query = session.query(FileEvent).order_by(FileEvent.timestamp.asc())
-    query = query.yield_per(chunk_size)
 
-    def day(file: FileEvent):
-        return (
-            file.timestamp.year,
-            file.timestamp.month,
-            file.timestamp.day,
-        )
+def download():
+    # setup
+    session = connection_manager.make_session()
+    chunk_size = 1024
+
+    load_verified_revisions(session)
+
+    # snapshots from a previous run that can be skipped
+    snapshots = list_snapshots()
 
-    for _, group in groupby(query, key=day):
-        download_revisions(list(group))
+    # initial state
+    (min_datetime,) = session.query(sa.func.min(FileEvent.timestamp)).one()
+    if snapshot_name(min_datetime) in snapshots:
+        logger.info("Resume from existing snapshots")
+    else:
+        make_initial_state(session, min_datetime)
+
+    # modifications
+    day_column = sa.func.date(FileEvent.timestamp)
+    query = (
+        session.query(day_column, sa.func.max(FileEvent.timestamp))
+        .group_by(day_column)
+        .order_by(day_column)
+    )
+    days = [(date.fromisoformat(day), max_datetime) for day, max_datetime in query]
+
+    for day, max_datetime in tqdm(days, unit="days"):
+        # the last snapshot of a day is taken at its last event
+        if snapshot_name(max_datetime) in snapshots:
+            logger.debug(f"Skip {day} with existing snapshot")
+            continue
+
+        start = datetime.combine(day, datetime.min.time())
+        end = start + timedelta(days=1)
+        is_in_day = (FileEvent.timestamp >= start, FileEvent.timestamp < end)
+
+        # plain rows instead of orm objects, which the workers could not use
+        # without the session and which carry much more state
+        query = (
+            sa.select(file_events)
+            .where(*is_in_day)
+            .order_by(FileEvent.timestamp.asc(), FileEvent.path.asc())
+            .execution_options(yield_per=chunk_size)
+        )
+        download_revisions(session.execute(query), snapshots)
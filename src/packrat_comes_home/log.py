@@ -4,14 +4,15 @@
 
 from __future__ import annotations
 
+import atexit
 import logging
 import warnings
-from multiprocessing import Queue
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
 from pathlib import Path
-from threading import Thread
+from queue import SimpleQueue
 
 logger = logging.getLogger("packrat")
-logging_thread: LoggingThread | None = None
+logging_listener: QueueListener | None = None
 
 
 def _showwarning(message, category, filename, lineno, file=None, line=None):
@@ -31,28 +32,25 @@ def setup_logging(level: str | int, log_path: Path) -> None:
         "%(message)s (%(filename)s:%(lineno)s)"
     )
 
-    handlers: list[logging.Handler] = [
-        logging.StreamHandler(),
-        logging.FileHandler(log_path, "a", errors="backslashreplace"),
-    ]
-    for handler in handlers:
+    stream_handler = logging.StreamHandler()
+    file_handler = logging.FileHandler(log_path, "a", errors="backslashreplace")
+    for handler in [stream_handler, file_handler]:
         handler.setFormatter(formatter)
-        root.addHandler(handler)
 
-    warnings.showwarning = _showwarning
-
-    global logging_thread
-    logging_thread = LoggingThread()
-    logging_thread.start()
+    # write the log file in batches, but errors right away
+    memory_handler = MemoryHandler(1024, flushLevel=logging.ERROR, target=file_handler)
+    handlers: list[logging.Handler] = [stream_handler, memory_handler]
 
+    # the handlers write from the listener thread, not from the logging threads
+    logging_queue: SimpleQueue[logging.LogRecord] = SimpleQueue()
+    root.addHandler(QueueHandler(logging_queue))
 
-class LoggingThread(Thread):
-    def __init__(self):
-        super().__init__(daemon=True)
-        self.logging_queue: Queue[logging.LogRecord] = Queue()
+    warnings.showwarning = _showwarning
 
-    def run(self) -> None:
-        while True:
-            record = self.logging_queue.get()
-            logger = logging.getLogger(record.name)
-            logger.handle(record)
+    global logging_listener
+    logging_listener = QueueListener(
+        logging_queue, *handlers, respect_handler_level=True
+    )
+    logging_listener.start()
+    # runs before logging.shutdown, which then flushes and closes the handlers
+    atexit.register(logging_listener.stop)
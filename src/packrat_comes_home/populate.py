@@ -2,17 +2,23 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 from itertools import chain
+from random import random
 from time import sleep
-from typing import Generator
+from typing import Any, Generator
 
+import sqlalchemy as sa
 import yaml
-from dropbox import Dropbox
-from dropbox.exceptions import ApiError
+from dropbox import Dropbox, create_session
+from dropbox.exceptions import ApiError, RateLimitError
 from dropbox.files import (
     DeletedMetadata,
     FileMetadata,
     FolderMetadata,
+    ListFolderContinueError,
     ListFolderResult,
     ListRevisionsResult,
     SymlinkInfo,
@@ -20,53 +26,103 @@ from dropbox.files import (
 from more_itertools import ichunked
 from requests import ConnectionError, ReadTimeout
 from sqlalchemy.orm import Session
-from sqlalchemy.sql import exists
 from tqdm import tqdm
 
 from .log import logger
-from .schema import (
-    ConnectionManager,
-    DeleteEvent,
-    FileError,
-    FileEvent,
-    ModifyEvent,
-    SymlinkEvent,
-)
+from .schema import ConnectionManager, Cursor, FileError, FileEvent
 
 chunk_size = 2**8
+max_delay = 6e1
+max_workers = 16
+cursor_id = "dropbox"
 connection_manager = ConnectionManager()
 
+file_events: sa.Table = FileEvent.__table__
+file_errors: sa.Table = FileError.__table__
+TableRow = tuple[sa.Table, dict[str, Any]]
+
 with open("config.yml", "r") as file_handle:
     configuration = yaml.load(file_handle, Loader=yaml.Loader)
 
-dbx = Dropbox(configuration["dropbox_token"])
+# the default pool keeps 8 connections, fewer than we have threads. dropbox paces
+# requests per user. rate limit errors are not retried by the sdk, so that
+# robust_call waits out the backoff that dropbox asks for
+dbx = Dropbox(
+    configuration["dropbox_token"],
+    max_retries_on_rate_limit=0,
+    session=create_session(max_connections=max_workers),
+)
 
 
 def robust_call(func, *args, **kwargs):
+    delay = 1.0
     while True:
         try:
             return func(*args, **kwargs)
         except (ReadTimeout, ConnectionError) as e:
             logger.error("Network error %s", exc_info=e)
-            sleep(1e1)
-
-
-def list_recursive() -> (
-    Generator[FileMetadata | FolderMetadata | DeletedMetadata, None, None]
-):
-    list_folder_result = robust_call(
-        dbx.files_list_folder,
-        "",
-        include_deleted=True,
-        include_mounted_folders=True,
-        recursive=True,
-    )
+            sleep(min(delay, max_delay) + random())  # jitter spreads out threads
+            delay *= 2
+        except RateLimitError as e:
+            logger.warning("Rate limited %s", exc_info=e)
+            sleep((e.backoff or min(delay, max_delay)) + random())
+
+
+def start_listing(cursor: Cursor) -> tuple[ListFolderResult, bool]:
+    """
+    Lists the first page of everything, or of only what changed since `cursor`
+    if it was saved by an earlier run. Also returns whether the listing continues
+    from the cursor, which is not the case if dropbox has reset it
+
+    """
+    list_folder_result = None
+    is_continued = False
+    if cursor.cursor is not None:
+        try:
+            list_folder_result = robust_call(
+                dbx.files_list_folder_continue,
+                cursor.cursor,
+            )
+            is_continued = True
+        except ApiError as e:
+            if not isinstance(e.error, ListFolderContinueError):
+                raise
+            if not e.error.is_reset():
+                raise
+            logger.warning("Cursor was reset, listing everything")
+
+    if list_folder_result is None:
+        list_folder_result = robust_call(
+            dbx.files_list_folder,
+            "",
+            include_deleted=True,
+            include_mounted_folders=True,
+            recursive=True,
+        )
     if not isinstance(list_folder_result, ListFolderResult):
         raise ValueError("Cannot handle list_folder_result %s", list_folder_result)
 
-    while list_folder_result.has_more is True:
+    return list_folder_result, is_continued
+
+
+def list_recursive(
+    cursor: Cursor,
+    list_folder_result: ListFolderResult,
+) -> Generator[FileMetadata | FolderMetadata | DeletedMetadata, None, None]:
+    """
+    Lists all pages starting from `list_folder_result`. The cursor is advanced
+    once all entries of a page were yielded
+
+    """
+    while True:
         yield from list_folder_result.entries
 
+        cursor.cursor = list_folder_result.cursor
+        cursor.updated_at = datetime.utcnow()
+
+        if list_folder_result.has_more is not True:
+            break
+
         list_folder_result = robust_call(
             dbx.files_list_folder_continue,
             list_folder_result.cursor,
@@ -75,9 +131,16 @@ def list_recursive() -> (
             raise ValueError("Cannot handle list_folder_result %s", list_folder_result)
 
 
+def file_event_row(**kwargs: Any) -> dict[str, Any]:
+    # all event types share one table, unused columns are null
+    row: dict[str, Any] = dict.fromkeys(file_events.columns.keys())
+    row.update(kwargs)
+    return row
+
+
 def list_revisions(
     m: FileMetadata | FolderMetadata | DeletedMetadata,
-) -> Generator[FileEvent | FileError, None, None]:
+) -> Generator[TableRow, None, None]:
     if isinstance(m, FolderMetadata):
         return
 
@@ -86,7 +149,7 @@ def list_revisions(
     try:
         list_revisions_result = robust_call(dbx.files_list_revisions, path)
     except ApiError as e:
-        yield FileError(path=path, message=repr(e))
+        yield file_errors, dict(path=path, message=repr(e))
         return
 
     if not isinstance(list_revisions_result, ListRevisionsResult):
@@ -110,45 +173,100 @@ def list_revisions(
 
         symlink_info = getattr(r, "symlink_info", None)
         if isinstance(symlink_info, SymlinkInfo):
-            yield SymlinkEvent(
+            yield file_events, file_event_row(
                 **file_event_kwargs,
+                type="symlink",
                 target=symlink_info.target,
             )
             continue
 
-        yield ModifyEvent(
+        yield file_events, file_event_row(
             **file_event_kwargs,
+            type="modify",
             size=r.size,
             content_hash=r.content_hash,
         )
 
     if list_revisions_result.is_deleted is True:
-        yield DeleteEvent(
+        yield file_events, file_event_row(
             path=path,
+            type="delete",
             is_deleted=True,
             is_downloadable=False,
             timestamp=list_revisions_result.server_deleted,
         )
 
 
-def check_path_unseen(session: Session, p: str) -> bool:
-    file_event_exists = session.query(exists().where(FileEvent.path == p)).scalar()
+def collect_revisions(
+    m: FileMetadata | FolderMetadata | DeletedMetadata,
+) -> list[TableRow]:
+    return list(list_revisions(m))
+
 
-    file_error_exists = session.query(exists().where(FileError.path == p)).scalar()
+def filter_unseen(
+    session: Session,
+    metadata: list[FileMetadata | FolderMetadata | DeletedMetadata],
+) -> list[FileMetadata | FolderMetadata | DeletedMetadata]:
+    paths = [m.path_display for m in metadata]
 
-    return (file_event_exists is not True) and (file_error_exists is not True)
+    query = sa.union(
+        sa.select(FileEvent.path).where(FileEvent.path.in_(paths)),
+        sa.select(FileError.path).where(FileError.path.in_(paths)),
+    )
+    seen: set[str] = set(session.scalars(query))
 
+    return [m for m in metadata if m.path_display not in seen]
 
-def populate():
-    for m_iter in tqdm(ichunked(list_recursive(), chunk_size), unit="chunks"):
-        session = connection_manager.make_session()
 
-        session.add_all(
-            chain.from_iterable(
-                list_revisions(m)
-                for m in tqdm(m_iter, total=chunk_size, unit="paths", leave=False)
-                if check_path_unseen(session, m.path_display)
-            )
-        )
+def load_cursor(full_rescan: bool = False) -> Cursor:
+    cursor: Cursor | None = None
+    if not full_rescan:
+        with connection_manager.make_session() as session:
+            cursor = session.get(Cursor, cursor_id)
+    if cursor is None:
+        cursor = Cursor(id=cursor_id, cursor=None, updated_at=None)
+    return cursor
+
+
+def populate(full_rescan: bool = False):
+    cursor = load_cursor(full_rescan)
+
+    # a continued listing also has paths that are known but have new revisions or
+    # were deleted. the insert skips revisions and deletes that are already known
+    list_folder_result, is_continued = start_listing(cursor)
+    metadata_iter = list_recursive(cursor, list_folder_result)
+
+    # the pool only makes dropbox calls, the session is used from this thread and
+    # committed after every chunk
+    with (
+        connection_manager.make_session() as session,
+        ThreadPoolExecutor(max_workers=max_workers) as executor,
+    ):
+        for m_iter in tqdm(ichunked(metadata_iter, chunk_size), unit="chunks"):
+            metadata = list(m_iter)
+            if not is_continued:
+                metadata = filter_unseen(session, metadata)
+            futures = [executor.submit(collect_revisions, m) for m in metadata]
+            revisions = (future.result() for future in as_completed(futures))
+
+            # rows of the same table have the same keys
+            inserts: defaultdict[sa.Table, list[dict[str, Any]]] = defaultdict(list)
+            for table, row in chain.from_iterable(
+                tqdm(revisions, total=len(futures), unit="paths", leave=False)
+            ):
+                inserts[table].append(row)
+
+            for table, rows in inserts.items():
+                insert = sa.insert(table).prefix_with("OR IGNORE", dialect="sqlite")
+                session.execute(insert, rows)
+
+            # all entries before the cursor are part of this or an earlier chunk
+            if cursor.cursor is not None:
+                session.merge(cursor)
+
+            session.commit()
 
-        session.commit()
+        # the cursor of the last page is set after its chunk was committed
+        if cursor.cursor is not None:
+            session.merge(cursor)
+            session.commit()
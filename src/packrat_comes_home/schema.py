@@ -5,9 +5,21 @@
 from dataclasses import dataclass
 from datetime import datetime
 
-from sqlalchemy import create_engine, Column, String, DateTime, Boolean, Integer
+from sqlalchemy import (
+    create_engine,
+    event,
+    inspect,
+    Column,
+    String,
+    DateTime,
+    Boolean,
+    Index,
+    Integer,
+    text,
+)
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import registry, Session, sessionmaker
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import QueuePool
 
 mapper_registry: registry = registry()
 
@@ -22,11 +34,24 @@ class FileEvent:
 
     type: str = Column(String, nullable=False)
 
-    timestamp: datetime = Column(DateTime, nullable=False, index=True)
+    timestamp: datetime = Column(DateTime, nullable=False)
 
     is_downloadable: bool = Column(Boolean, nullable=False)
     is_deleted: bool = Column(Boolean, nullable=False)
 
+    __table_args__ = (
+        Index("ix_file_events_path_timestamp", "path", "timestamp"),
+        Index("ix_file_events_timestamp_path", "timestamp", "path"),
+        # deletes have no revision, which is never a conflict in the primary key
+        Index(
+            "ix_file_events_delete_path_timestamp",
+            "path",
+            "timestamp",
+            unique=True,
+            sqlite_where=text("type = 'delete'"),
+        ),
+    )
+
     __mapper_args__ = dict(
         polymorphic_on="type",
         polymorphic_identity="file_event",
@@ -72,12 +97,77 @@ class FileError:
     message: str | None = Column(String, nullable=True)
 
 
+@mapper_registry.mapped
+@dataclass
+class Cursor:
+    __tablename__ = "cursors"
+
+    id: str = Column(String, primary_key=True)
+
+    # none until the first listing, but only stored once it was set
+    cursor: str | None = Column(String, nullable=False)
+    updated_at: datetime | None = Column(DateTime, nullable=False)
+
+
+@mapper_registry.mapped
+@dataclass
+class VerifiedRevision:
+    __tablename__ = "verified_revisions"
+
+    path: str = Column(String, primary_key=True)
+    revision: str = Column(String, primary_key=True)
+
+    content_hash: str | None = Column(String(64), nullable=True)
+
+    # stat of the file after it was verified
+    size: int = Column(Integer, nullable=False)
+    mtime: int = Column(Integer, nullable=False)  # nanoseconds
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")  # readers do not block writers
+    cursor.execute("PRAGMA synchronous=NORMAL")  # safe with wal
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MiB
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
 class ConnectionManager:
     def __init__(self, url: str = "sqlite:///packrat.db") -> None:
-        self.engine = create_engine(url, poolclass=NullPool)
-        self.engine.connect()
+        is_sqlite = make_url(url).get_backend_name() == "sqlite"
+
+        connect_args = dict()
+        if is_sqlite:  # pooled connections are shared between threads
+            connect_args["check_same_thread"] = False
+
+        self.engine = create_engine(
+            url,
+            poolclass=QueuePool,
+            pool_size=8,
+            connect_args=connect_args,
+        )
+        if is_sqlite:
+            event.listen(self.engine, "connect", set_sqlite_pragmas)
+        self.engine.connect().close()
 
         mapper_registry.metadata.create_all(self.engine)
+        inspector = inspect(self.engine)
+        is_index_created = False
+        for table in mapper_registry.metadata.tables.values():
+            index_names = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:  # not created for existing tables
+                if index.name in index_names:
+                    continue
+                index.create(self.engine)
+                is_index_created = True
+
+        with self.engine.begin() as connection:
+            # superseded by ix_file_events_timestamp_path
+            connection.execute(text("DROP INDEX IF EXISTS ix_file_events_timestamp"))
+            if is_index_created:  # statistics for the query planner
+                connection.execute(text("ANALYZE"))
         self.sessionmaker = sessionmaker(bind=self.engine)
 
     def make_session(self) -> Session:
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import importlib
+import sys
+from types import ModuleType
+
+import pytest
+
+
+def load_module(name: str) -> ModuleType:
+    # the modules read their configuration and open the database on import
+    module = sys.modules.get(name)
+    if module is None:
+        return importlib.import_module(name)
+    return importlib.reload(module)
+
+
+@pytest.fixture
+def configuration(tmp_path, monkeypatch) -> None:
+    (tmp_path / "config.yml").write_text(
+        "dropbox_token: token\nzfs_data_set: pool/data\n"
+    )
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def download(configuration) -> ModuleType:
+    return load_module("packrat_comes_home.download")
+
+
+@pytest.fixture
+def populate(configuration) -> ModuleType:
+    return load_module("packrat_comes_home.populate")
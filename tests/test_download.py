@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+from datetime import datetime
+from io import BytesIO
+from threading import Semaphore
+from types import SimpleNamespace
+
+import pytest
+import requests
+from dropbox.exceptions import RateLimitError
+
+
+def test_rate_limit_reaches_robust_call(download, monkeypatch):
+    calls = list()
+
+    def post(self, *args, **kwargs):
+        calls.append(None)
+        response = requests.Response()
+        response.status_code = 429
+        response.headers["retry-after"] = "1"
+        response.raw = BytesIO(b"")
+        return response
+
+    monkeypatch.setattr(requests.Session, "post", post)
+
+    with pytest.raises(RateLimitError):
+        download.dbx.files_download("rev:a1c10ce0dd78")
+    assert len(calls) == 1  # not retried by the sdk
+
+
+def test_rate_limit_decreases_limit(download, monkeypatch):
+    monkeypatch.setattr(download, "sleep", lambda seconds: None)
+    limiter = download.AdaptiveLimiter(16)
+    monkeypatch.setattr(download, "small_file_limiter", limiter)
+
+    calls = list()
+
+    def func():
+        calls.append(None)
+        if len(calls) == 1:
+            raise RateLimitError("request_id", backoff=1)
+        return "result"
+
+    assert download.robust_call(func) == "result"
+    assert limiter.limit == 8
+
+
+@pytest.mark.parametrize("chunk_size", [2**20, 1000003])
+def test_content_hasher(download, tmp_path, chunk_size):
+    block_size = download.block_size
+    for size in [0, 1, block_size - 1, block_size, block_size + 1, 2 * block_size]:
+        data = os.urandom(size)
+        path = tmp_path / "file"
+        path.write_bytes(data)
+
+        slots = Semaphore(2)
+        hasher = download.ContentHasher(download.hash_executor, slots)
+        for offset in range(0, size, chunk_size):
+            hasher.update(data[offset : offset + chunk_size])
+
+        assert hasher.hexdigest() == download.dropbox_hash(path), size
+        assert slots.acquire(blocking=False) and slots.acquire(blocking=False)
+
+
+def test_split_batches(download):
+    files = [SimpleNamespace(path=path) for path in ["a", "b", "a", "c", "b"]]
+
+    batches = [[file.path for file in batch] for batch in download.split_batches(files)]
+
+    assert batches == [["a", "b"], ["a", "c", "b"]]
+    assert list(download.split_batches([])) == []
+
+
+def test_download_revisions_skips_existing_snapshots(download, monkeypatch):
+    downloaded = list()
+    snapshots = list()
+    monkeypatch.setattr(download, "download_file", downloaded.append)
+    monkeypatch.setattr(download, "take_snapshot", snapshots.append)
+
+    timestamps = [datetime(2020, 1, 1, hour) for hour in range(3)]
+    files = [
+        SimpleNamespace(
+            path="a",
+            revision=str(i),
+            type="modify",
+            is_downloadable=False,
+            timestamp=timestamp,
+        )
+        for i, timestamp in enumerate(timestamps)
+    ]
+    existing = {download.snapshot_name(timestamp) for timestamp in timestamps[:2]}
+
+    download.download_revisions(files, existing)
+
+    assert downloaded == files[2:]
+    assert snapshots == timestamps[2:]
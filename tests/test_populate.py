@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+from datetime import datetime
+from types import SimpleNamespace
+
+import sqlalchemy as sa
+from dropbox.exceptions import ApiError
+from dropbox.files import (
+    DeletedMetadata,
+    ListFolderContinueError,
+    ListFolderResult,
+    ListRevisionsResult,
+)
+
+
+def deleted(path: str) -> DeletedMetadata:
+    return DeletedMetadata(name=path.lstrip("/"), path_lower=path, path_display=path)
+
+
+def page(cursor: str, has_more: bool, *paths: str) -> ListFolderResult:
+    entries = [deleted(path) for path in paths]
+    return ListFolderResult(entries=entries, cursor=cursor, has_more=has_more)
+
+
+def test_list_recursive_yields_last_page(populate):
+    pages = {"c1": page("c2", False, "/b")}
+    populate.dbx = SimpleNamespace(files_list_folder_continue=pages.pop)
+    cursor = populate.load_cursor()
+
+    metadata = populate.list_recursive(cursor, page("c1", True, "/a"))
+
+    assert [m.path_display for m in metadata] == ["/a", "/b"]
+    assert cursor.cursor == "c2"
+
+
+def test_list_recursive_single_page(populate):
+    cursor = populate.load_cursor()
+
+    metadata = populate.list_recursive(cursor, page("c1", False, "/a"))
+
+    assert [m.path_display for m in metadata] == ["/a"]
+    assert cursor.cursor == "c1"
+
+
+def test_start_listing_after_reset(populate):
+    def files_list_folder_continue(cursor):
+        raise ApiError("request_id", ListFolderContinueError.reset, None, None)
+
+    populate.dbx = SimpleNamespace(
+        files_list_folder_continue=files_list_folder_continue,
+        files_list_folder=lambda *args, **kwargs: page("c2", False, "/a"),
+    )
+    cursor = populate.load_cursor()
+    cursor.cursor = "c1"
+
+    list_folder_result, is_continued = populate.start_listing(cursor)
+
+    assert list_folder_result.cursor == "c2"
+    assert is_continued is False
+
+
+def test_populate_saves_and_resumes_cursor(populate):
+    populate.chunk_size = 1  # the last chunk ends with the last page
+
+    server_deleted = datetime(2020, 1, 1)
+    listed = list()
+
+    def files_list_folder(*args, **kwargs):
+        listed.append(None)
+        return page("c1", False, "/x")
+
+    continued = list()
+
+    def files_list_folder_continue(cursor):
+        continued.append(cursor)
+        return page("c2", False, "/x")
+
+    def files_list_revisions(path):
+        return ListRevisionsResult(
+            is_deleted=True, entries=[], server_deleted=server_deleted
+        )
+
+    populate.dbx = SimpleNamespace(
+        files_list_folder=files_list_folder,
+        files_list_folder_continue=files_list_folder_continue,
+        files_list_revisions=files_list_revisions,
+    )
+
+    populate.populate()
+    assert populate.load_cursor().cursor == "c1"
+
+    populate.populate()
+    assert populate.load_cursor().cursor == "c2"
+
+    assert len(listed) == 1
+    assert continued == ["c1"]
+
+    query = sa.select(populate.file_events.c.path, populate.file_events.c.type)
+    with populate.connection_manager.make_session() as session:
+        assert session.execute(query).all() == [("/x", "delete")]